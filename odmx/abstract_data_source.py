@@ -11,6 +11,11 @@ class DataSource(ABC):
     """
     Abstract class for a given datasource entry.
     """
+    # Data sources that set this may be harvested at the same time as each
+    # other, in worker threads. Only set it if harvest just waits on a remote
+    # service and writes to files no other data source touches.
+    parallel_harvest = False
+
     @abstractmethod
     def __init__(self, project_name, project_path, data_path):
         """
@@ -6,11 +6,16 @@ Module for Hydrovu data harvesting, ingestion, and processing.
 
 import os
 from importlib.util import find_spec
-from string import Template
 import datetime
-from functools import cache
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import filelock
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yaml
+import numpy as np
 import pandas as pd
 from odmx.support.file_utils import open_csv, open_json, clean_name
 from odmx.abstract_data_source import DataSource
@@ -24,6 +29,121 @@ from odmx.write_equipment_jsons import gen_equipment_entry,\
 
 mapper_path = find_spec("odmx.mappers").submodule_search_locations[0]
 json_schema_files = find_spec("odmx.json_schema").submodule_search_locations[0]
+# A Hydrovu reading, unix timestamp and value
+_reading_dtype = np.dtype([('timestamp', np.int64), ('value', np.float64)])
+
+def _read_last_timestamp(file_name, block_size=4096):
+    """
+    Read the unix timestamp of the last row of a harvested Hydrovu csv
+    without reading the whole file.
+
+    @param file_name Path of the harvested csv.
+    @param block_size Number of bytes to step back from the end of the file at
+                      a time while looking for the last line.
+    @return The last timestamp, or None if the file has no data rows.
+    """
+    with open(file_name, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        start = end
+        tail = b''
+        # Step back until we have a full non empty line (or the whole file)
+        while start > 0:
+            start = max(start - block_size, 0)
+            f.seek(start)
+            tail = f.read(end - start)
+            if tail.rstrip().count(b'\n') >= 1:
+                break
+    lines = [line for line in tail.splitlines() if line.strip()]
+    if not lines:
+        return None
+    try:
+        return int(float(lines[-1].split(b',')[0]))
+    except ValueError:
+        pass
+    # Either only the header is there or the last line isn't what we
+    # expect, so fall back to reading the timestamp column.
+    timestamps = pd.read_csv(file_name, usecols=[0]).iloc[:, 0].dropna()
+    if timestamps.empty:
+        return None
+    return int(timestamps.max())
+
+
+# Bearer tokens by auth file, with the time they should be renewed at
+_token_cache = {}
+
+
+@lru_cache
+def _read_auth_params(auth_file):
+    """
+    Read the Hydrovu API credentials.
+
+    @param auth_file Path of the yaml file with the credentials.
+    @return A dictionary with the auth url, client id and client secret.
+    """
+    with open(auth_file, encoding="utf-8") as file:
+        return yaml.load(file, Loader=yaml.FullLoader)
+
+
+def _append_to_csv(file_name, data_df, header):
+    """
+    Append a page of harvested data to the csv, writing only the new rows.
+
+    @param file_name Path of the harvested csv.
+    @param data_df The new rows, indexed by timestamp.
+    @param header The current header of the csv, or None if it doesn't exist
+                  yet.
+    @return The header of the csv after writing.
+    """
+    if header is None:
+        data_df.to_csv(file_name)
+    elif set(data_df.columns) <= set(header[1:]):
+        # Line the columns up with the existing file, parameters that aren't
+        # in this page are left empty.
+        data_df.reindex(columns=header[1:]).to_csv(file_name, mode='a',
+                                                   header=False)
+        return header
+    else:
+        # A parameter we haven't seen before, so the header has to change and
+        # the file has to be rewritten.
+        vprint(f"New parameters for {file_name}, rewriting it")
+        existing_df = pd.read_csv(file_name, index_col=0)
+        data_df = pd.concat((existing_df, data_df))
+        data_df.to_csv(file_name)
+    return [data_df.index.name] + data_df.columns.tolist()
+
+
+@lru_cache
+def _load_mappers():
+    """
+    Read the Hydrovu parameter and unit mappers and build the lookups used
+    while harvesting and ingesting. This only happens once per process.
+
+    @return The parameter and unit frames indexed by Hydrovu id, the nice
+            names by id for parameters and units, and the cv terms by clean
+            name for parameters and units.
+    """
+    # There are two ids with clean_name "density" but both map to the same
+    # cv term, so don't check for duplicates (doesn't matter)
+    # We don't use level_elevation so that cv_term is intentionally null
+    param_df = pd.DataFrame(
+        open_json(f'{mapper_path}/hydrovu_parameters.json'))
+    param_df.set_index('id', inplace=True, verify_integrity=True)
+
+    unit_df = pd.DataFrame(open_json(f'{mapper_path}/hydrovu_units.json'))
+    unit_df.set_index('id', inplace=True, verify_integrity=True)
+    # Plain dicts for the per-page lookups in harvest, indexing a Series
+    # by label is much slower than a dict lookup.
+    param_nice = param_df['nice_name'].to_dict()
+    unit_nice = unit_df['nice_name'].to_dict()
+    # Same for the cv terms by clean name used when mapping columns. For
+    # the duplicate clean names (density) the first one wins, it doesn't
+    # matter which.
+    param_cv_by_clean = param_df.drop_duplicates(
+        'clean_name').set_index('clean_name')['cv_term'].to_dict()
+    unit_cv_by_clean = dict(zip(unit_df['clean_name'], unit_df['cv_term']))
+    return (param_df, unit_df, param_nice, unit_nice, param_cv_by_clean,
+            unit_cv_by_clean)
+
 
 class HydrovuDataSource(DataSource):
     """
@@ -50,26 +170,35 @@ class HydrovuDataSource(DataSource):
         self.equipment_directory = (f'hydrovu/{device_name}_{device_type}')
         self.feeder_table = f'{device_name.lower()}_{device_type.lower()}'
         self.data_source_timezone = data_source_timezone
-        # There are two ids with clean_name "density" but both map to the same
-        # cv term, so don't check for duplicates (doesn't matter)
-        # We don't use level_elevation so that cv_term is intentionally null
-        self.param_df = pd.DataFrame(
-            open_json(f'{mapper_path}/hydrovu_parameters.json'))
-        self.param_df.set_index('id', inplace=True, verify_integrity=True)
-
-        self.unit_df = pd.DataFrame(
-            open_json(f'{mapper_path}/hydrovu_units.json'))
-        self.unit_df.set_index('id', inplace=True, verify_integrity=True)
-
-    @cache
+        # The mappers never change, so every device shares the same frames
+        # and lookups. Treat them as read only.
+        (self.param_df, self.unit_df, self._param_nice, self._unit_nice,
+         self._param_cv_by_clean, self._unit_cv_by_clean) = _load_mappers()
+        # One session for all of the API pages so the connection is reused
+        # instead of a new TCP/TLS handshake per page. The adapter takes care
+        # of retrying on throttling and server errors.
+        self._session = requests.Session()
+        retries = Retry(total=5, backoff_factor=0.3,
+                        status_forcelist=[429, 500, 502, 503, 504])
+        self._session.mount('https://',
+                            HTTPAdapter(pool_connections=10, pool_maxsize=10,
+                                        max_retries=retries))
+
     def get_bearer_token(self, auth_yml):
-        """Get bearer token"""
+        """
+        Get bearer token
+
+        Tokens are shared between devices using the same credentials and
+        renewed a minute before they expire.
+        """
+        cached = _token_cache.get(auth_yml)
+        if cached is not None and time.time() < cached[1]:
+            return cached[0]
 
         # Define parameters for the API call.
         auth = auth_yml
         auth_file = f"{os.environ.get('SSI_BASE', '/opt/ssi')}/{auth}"
-        with open(auth_file, encoding="utf-8") as file:
-            auth_params = yaml.load(file, Loader=yaml.FullLoader)
+        auth_params = _read_auth_params(auth_file)
 
         auth_url = auth_params['auth_url']
         client_id = auth_params['client_id']
@@ -80,7 +209,10 @@ class HydrovuDataSource(DataSource):
                         "scope": "read:locations"}
         r = requests.post(auth_url, token_params)
         r.raise_for_status()
-        token = r.json()['access_token']
+        token_response = r.json()
+        token = token_response['access_token']
+        expires_in = token_response.get('expires_in', 3600)
+        _token_cache[auth_yml] = (token, time.time() + expires_in - 60)
         return token
 
     def harvest(self, auth_yml):
@@ -90,69 +222,152 @@ class HydrovuDataSource(DataSource):
         """
         base_url = 'https://www.hydrovu.com/public-api/v1/'
         token = self.get_bearer_token(auth_yml)
-        data_request = Template(f"{base_url}locations/"
-                                "${alias}/data?startTime=${start_time}")
         headers = {'accept': 'application/json',
                    'authorization': f"Bearer {token}"}
 
         location_id = self.device_id
+        data_url = f"{base_url}locations/{location_id}/data"
         file_name = self.data_source_path
         vprint(' harvesting to file ', file_name)
+        # New pages are appended to the file as they come in, so we never
+        # hold the whole history in memory. From the existing file we only need
+        # the header and the last timestamp.
+        header = None
+        last_timestamp = 0
         if os.path.exists(file_name):
-            # Read the file in as a pandas dataframe.
-            existing_df = pd.read_csv(file_name)
-            # Set the timestamp column as the index.
-            existing_df.set_index('timestamp', inplace=True)
-            # Sort the dataframe by the index.
-            existing_df.sort_index(inplace=True)
+            header = pd.read_csv(file_name, nrows=0).columns.tolist()
             # get last timestamp as unix utc
-            # vprint('existing_df: ', existing_df)
-            last_timestamp = existing_df.index[-1] + 1  # Add one for API
-            # reasons
-        else:
-            existing_df = pd.DataFrame()
-            last_timestamp = 0
-        count = 0
-        while True:
+            file_last_timestamp = _read_last_timestamp(file_name)
+            if file_last_timestamp is not None:
+                last_timestamp = file_last_timestamp + 1  # Add one for API
+                # reasons
+
+        def get_page(start_time):
             vprint("last_timstamp : ",
-                   datetime.datetime.fromtimestamp(last_timestamp))
+                   datetime.datetime.fromtimestamp(start_time))
             vprint('device_id : ', location_id)
             vprint(f"name : {self.device_name}_{self.device_type}")
-            feature_url = data_request.substitute(alias=location_id,
-                                                  start_time=last_timestamp)
-            data = requests.get(feature_url, headers=headers).json()
-            # vprint('data : ', data)
-            # Check if anything was returned.
-            data_df = pd.DataFrame()
-            # vprint('data_df : ', data_df)
-            # vprint('data[parameters] : ', data['parameters'])
-            for param in data['parameters']:
-                # vprint('param : ', param)
-                nice_name = self.param_df['nice_name'][param['parameterId']]
-                nice_unit = self.unit_df['nice_name'][param['unitId']]
-                col_name = f"{nice_name}[{nice_unit}]"
-                readings = param['readings']
-                param_data = pd.DataFrame(readings,
-                                          columns=['timestamp', 'value'])
-                param_data = param_data.set_index('timestamp')
-                param_data.rename(columns={'value': col_name}, inplace=True)
-                data_df = pd.concat((data_df, param_data), axis=1)
-            print(data_df)
-            vprint((f"hydrovu: Data collected for {self.device_name} "
-                    f"page {count}"))
-            if len(data_df) == 0:
-                break
-            count += 1
-            # vprint('existing_df : ', existing_df)
-            # vprint('data_df : ', data_df)
-            existing_df = pd.concat((existing_df, data_df))
-            last_timestamp = data_df.index[-1] + 1
+            feature_url = f"{data_url}?startTime={start_time}"
+            response = self._session.get(feature_url, headers=headers,
+                                         timeout=30)
+            response.raise_for_status()
+            return response.json()
+
+        count = 0
+        # The next page starts after the last timestamp of this one, so pages
+        # can't be requested ahead of time. What we can do is fetch the next
+        # page in the background while this one is written to the csv.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(get_page, last_timestamp)
+            while True:
+                data = next_page.result()
+                # vprint('data : ', data)
+                # vprint('data[parameters] : ', data['parameters'])
+                # One series per parameter, the frame is built (and the
+                # timestamps aligned) once at the end.
+                series_by_col = {}
+                for param in data['parameters']:
+                    # vprint('param : ', param)
+                    nice_name = self._param_nice[param['parameterId']]
+                    nice_unit = self._unit_nice[param['unitId']]
+                    col_name = f"{nice_name}[{nice_unit}]"
+                    readings = param['readings']
+                    # Straight into a typed array in one pass over the
+                    # readings, no intermediate lists or frames
+                    readings_arr = np.fromiter(
+                        ((reading['timestamp'], reading['value'])
+                         for reading in readings),
+                        dtype=_reading_dtype, count=len(readings))
+                    series_by_col[col_name] = pd.Series(
+                        readings_arr['value'],
+                        index=readings_arr['timestamp'], name=col_name)
+                data_df = pd.DataFrame(series_by_col)
+                data_df.index.name = 'timestamp'
+                vprint(data_df)
+                vprint((f"hydrovu: Data collected for {self.device_name} "
+                        f"page {count}"))
+                if len(data_df) == 0:
+                    break
+                count += 1
+                # vprint('data_df : ', data_df)
+                data_df.sort_index(inplace=True)
+                last_timestamp = data_df.index[-1] + 1
+                next_page = executor.submit(get_page, last_timestamp)
+                header = _append_to_csv(file_name, data_df, header)
         if count > 0:
-            existing_df.to_csv(file_name)
             vprint(f"hydrovu: Data saved for {self.device_name}")
         else:
             vprint(f"hydrovu: No new data for {self.device_name}")
 
+    def _update_equipment_jsons(self, columns, start):
+        """
+        Add any new columns to the equipment jsons of the device, creating
+        them if they don't exist yet.
+
+        @param columns The cleaned column names of the harvested data.
+        @param start The earliest timestamp of the data, used as the start
+                     date of new equipment.
+        """
+        # Set up paths
+        equip_path = (f"{self.project_path}/odmx/equipment/"
+                      f"{self.equipment_directory}")
+
+        equip_file = f"{equip_path}/equipment.json"
+        data_to_equipment_map_file = (f"{equip_path}/"
+                                      "data_to_equipment_map.json")
+        # Read equipment.json if it exists, otherwise start new
+        if os.path.isfile(equip_file):
+            equip_schema = os.path.join(json_schema_files,
+                                        'equipment_schema.json')
+            vprint(f"Reading existing equipment from {equip_file}")
+            equipment = open_json(equip_file,
+                                  validation_path=equip_schema)[0]
+        else:
+            os.makedirs(self.equipment_directory, exist_ok=True)
+            equipment = gen_equipment_entry(
+                acquiring_instrument_uuid=None,
+                name=self.device_type,
+                code=self.device_code,
+                serial_number=self.device_id,
+                relationship_start_date_time_utc=start,
+                position_start_date_utc=start,
+                vendor="In Situ")
+            vprint(f"Equipment entry: {equipment}")
+
+        # Retrieve device uuid from equipment dict
+        dev_uuid = equipment['equipment_uuid']
+
+        # Same for data to equipment map
+        data_to_equip, col_list =\
+        read_or_start_data_to_equipment_json(data_to_equipment_map_file,
+                                             equipment)
+
+        # Only columns that aren't mapped yet need any work
+        mapped_cols = set(col_list)
+        unmapped_cols = [column_name for column_name in columns
+                         if column_name not in mapped_cols]
+        for column_name in unmapped_cols:
+            name, _, unit_name = column_name.partition("[")
+            variable_domain_cv = "instrumentMeasurement"
+            variable_term = self._param_cv_by_clean[name]
+            unit = self._unit_cv_by_clean[unit_name[:-1]]
+            expose_as_datastream = True
+            if variable_term is None:
+                continue
+            data_to_equip.append(
+                gen_data_to_equipment_entry(
+                    column_name=column_name,
+                    var_domain_cv=variable_domain_cv,
+                    acquiring_instrument_uuid=dev_uuid,
+                    variable_term=variable_term,
+                    expose_as_ds=expose_as_datastream,
+                    units_term=unit))
+        vprint(f"Data to equipment map : {data_to_equip}")
+        # Write the new files
+        print("Writing equipment jsons.")
+        check_diff_and_write_new(data_to_equip, data_to_equipment_map_file)
+        check_diff_and_write_new([equipment], equip_file)
+
     def ingest(self, feeder_db_con, update_equipment_jsons):
         """
         Manipulate harvested Hydrovu data in a file on the server into a feeder
@@ -160,93 +375,28 @@ class HydrovuDataSource(DataSource):
         """
         csv_path = self.data_source_path
         vprint(f"Reading {csv_path}")
-        # Get the actual data.
-        args = {'float_precision': 'high'}
-        df: pd.DataFrame = pd.DataFrame(open_csv(csv_path, args=args,
-                                                 lock=True))
-
-        # Rename all of the column headers.
-        new_cols = []
-        for col in df.columns.tolist():
-            new_col = clean_name(col)
-            new_cols.append(new_col)
-
-        # Write equipment jsons if update_equipment_jsons is true
-        if update_equipment_jsons:
-            # Set up paths
-            equip_path = (f"{self.project_path}/odmx/equipment/"
-                          f"{self.equipment_directory}")
-
-            equip_file = f"{equip_path}/equipment.json"
-            data_to_equipment_map_file = (f"{equip_path}/"
-                                          "data_to_equipment_map.json")
-            # Get earliest timestamp for equipment start date
-            start = int(df.iloc[0]['timestamp'])
-
-            # Read equipment.json if it exists, otherwise start new
-            if os.path.isfile(equip_file):
-                equip_schema = os.path.join(json_schema_files,
-                                            'equipment_schema.json')
-                vprint(f"Reading existing equipment from {equip_file}")
-                equipment = open_json(equip_file,
-                                      validation_path=equip_schema)[0]
-            else:
-                os.makedirs(self.equipment_directory, exist_ok=True)
-                equipment = gen_equipment_entry(
-                    acquiring_instrument_uuid=None,
-                    name=self.device_type,
-                    code=self.device_code,
-                    serial_number=self.device_id,
-                    relationship_start_date_time_utc=start,
-                    position_start_date_utc=start,
-                    vendor="In Situ")
-                vprint(f"Equipment entry: {equipment}")
-
-            # Retrieve device uuid from equipment dict
-            dev_uuid = equipment['equipment_uuid']
-
-            # Same for data to equipment map
-            data_to_equip, col_list =\
-            read_or_start_data_to_equipment_json(data_to_equipment_map_file,
-                                                 equipment)
-
-            # Setup mappers with column names for lookup
-            param_lookup = self.param_df.set_index('clean_name')
-            unit_lookup = self.unit_df.set_index('clean_name')
-
-            # Drop duplicate keys (density), here we don't need them
-            param_lookup = \
-                param_lookup[~param_lookup.index.duplicated(keep='first')]
-
-            for column_name in new_cols:
-                if column_name in col_list:
-                    continue
-                name, unit_name = column_name.split("[")
-                variable_domain_cv = "instrumentMeasurement"
-                variable_term = param_lookup['cv_term'][name]
-                unit = unit_lookup['cv_term'][unit_name[:-1]]
-                expose_as_datastream = True
-                if variable_term is None:
-                    continue
-                data_to_equip.append(
-                    gen_data_to_equipment_entry(
-                        column_name=column_name,
-                        var_domain_cv=variable_domain_cv,
-                        acquiring_instrument_uuid=dev_uuid,
-                        variable_term=variable_term,
-                        expose_as_ds=expose_as_datastream,
-                        units_term=unit))
-            vprint(f"Data to equipment map : {data_to_equip}")
-            # Write the new files
-            print("Writing equipment jsons.")
-            check_diff_and_write_new(data_to_equip, data_to_equipment_map_file)
-            check_diff_and_write_new([equipment], equip_file)
-
-        df.columns = new_cols
-        df.set_index('timestamp', inplace=True)
-        # Convert unix timestamp to utc timestamp (without timzone)
-        df['timestamp'] = pd.to_datetime(df.index, unit='s')
-        general_timeseries_ingestion(feeder_db_con, self.feeder_table, df)
+        # Get the actual data. It's read and ingested a chunk at a time so the
+        # whole history never has to be in memory. The rows are in time order,
+        # so the ingestion skips chunks that are already in the feeder table.
+        args = {'float_precision': 'high', 'chunksize': 200_000}
+        # Hold the lock for the whole read, not just while opening the file
+        with filelock.FileLock(f'{csv_path}.lock', timeout=300), \
+                open_csv(csv_path, args=args) as reader:
+            for chunk_number, df in enumerate(reader):
+                if chunk_number == 0:
+                    # Rename all of the column headers.
+                    new_cols = [clean_name(col) for col in df.columns]
+                    # Write equipment jsons if update_equipment_jsons is true,
+                    # the earliest timestamp is the equipment start date
+                    if update_equipment_jsons:
+                        self._update_equipment_jsons(
+                            new_cols, int(df.iloc[0]['timestamp']))
+                df.columns = new_cols
+                # Convert unix timestamp to utc timestamp (without timzone),
+                # the ingestion doesn't use the index so convert in place
+                df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+                general_timeseries_ingestion(feeder_db_con, self.feeder_table,
+                                             df)
 
     def process(self, feeder_db_con, odmx_db_con, sampling_feature_code):
         """
@@ -7,9 +7,11 @@ Module for NWIS data harvesting, ingestion, and processing.
 import os
 from importlib.util import find_spec
 import datetime
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from dataretrieval import nwis
-from odmx.support.file_utils import open_csv, open_json
+from odmx.support.file_utils import open_csv, open_json,\
+    get_last_timestamp_csv
 from odmx.abstract_data_source import DataSource
 from odmx.timeseries_ingestion import general_timeseries_ingestion
 from odmx.timeseries_processing import general_timeseries_processing
@@ -22,10 +24,43 @@ from odmx.log import vprint
 mapper_path = find_spec("odmx.mappers").submodule_search_locations[0]
 json_schema_files = find_spec("odmx.json_schema").submodule_search_locations[0]
 
+@lru_cache
+def _load_mapper():
+    """
+    Read the NWIS parameter mapper. This only happens once per process.
+
+    @return The mapper indexed by USGS parameter id, and the cv terms and cv
+            units by clean name for mapping the ingested columns.
+    """
+    param_df = pd.DataFrame(open_json(f'{mapper_path}/nwis.json'))
+    param_df.set_index("id", inplace=True, verify_integrity=True)
+    cv_term = dict(zip(param_df['clean_name'], param_df['cv_term']))
+    cv_unit = dict(zip(param_df['clean_name'], param_df['cv_unit']))
+    return param_df, cv_term, cv_unit
+
+# The instantaneous values service has no data from before October 2007
+_IV_SERVICE_START = datetime.datetime(2007, 10, 1)
+
+def _year_ranges(start, end):
+    """
+    Split a time range into ranges that don't cross a new year.
+
+    @param start The start of the range.
+    @param end The end of the range.
+    @return A list of (start, end) tuples, in order.
+    """
+    ranges = []
+    for year in range(start.year, end.year + 1):
+        ranges.append((max(start, datetime.datetime(year, 1, 1)),
+                       min(end, datetime.datetime(year, 12, 31, 23, 59, 59))))
+    return ranges
+
 class NwisDataSource(DataSource):
     """
     Class for NWIS data source objects.
     """
+    # Each site is its own request to USGS and its own csv
+    parallel_harvest = True
 
     def __init__(self, project_name, project_path, data_path,
                  data_source_timezone, site_code):
@@ -37,13 +72,16 @@ class NwisDataSource(DataSource):
         self.site_code = site_code
         self.feeder_table = f'nwis_{site_code}'
         self.equipment_directory = f'nwis/nwis_{site_code}'
-        self.param_df = pd.DataFrame(open_json(f'{mapper_path}/nwis.json'))
-        self.param_df.set_index("id", inplace=True, verify_integrity=True)
+        # The mapper is shared by every site, treat it as read only.
+        self.param_df, self._cv_term, self._cv_unit = _load_mapper()
 
     def harvest(self):
         """
         Harvest NWIS data from the API and save it to a .csv on our servers.
         """
+        # dataretrieval is only needed here, so don't pay for importing it
+        # (and its dependencies) when we only ingest or process.
+        from dataretrieval import nwis  # pylint: disable=import-outside-toplevel
 
         # Define variables from the harvesting info file.
         local_base_path = os.path.join(self.data_path, self.data_source_path)
@@ -58,84 +96,100 @@ class NwisDataSource(DataSource):
         file_path = os.path.join(local_base_path, file_name)
         # If it does, we want to find only new data.
         server_df = None
+        last_server_time = None
         if os.path.isfile(file_path):
-            # Grab the data from the server.
-            args = {'parse_dates': [0], }
+            # New data is appended to the file, so all we need from it is the
+            # header and the latest timestamp (from the last line).
+            args = {'nrows': 0, }
             server_df = open_csv(file_path, args=args, lock=True)
-            # Find the latest timestamp.
-            last_server_time = server_df['datetime'].max()
-            if isinstance(last_server_time, str):
-                last_server_time = datetime.datetime.strptime(
-                    last_server_time, '%Y-%m-%d %H:%M:%S'
-                )
+            last_server_time = get_last_timestamp_csv(
+                file_path,
+                timestamp_index=server_df.columns.get_loc('datetime'))
             # Add a minute to it so that we don't get it in the return (the
             # data is never so granular anyway).
             start = last_server_time + datetime.timedelta(minutes=1)
             end = datetime.datetime.utcnow().replace(microsecond=0)
         # If it doesn't, we want all available data.
         else:
-            # The earliest start date NWIS allows one to use is 1900-01-01.
-            # However, their system still claims that's too early, so we
-            # add a day.
-            start = datetime.datetime(1900, 1, 2)
+            # There is nothing to ask for before the instantaneous values
+            # service begins.
+            start = _IV_SERVICE_START
             end = datetime.datetime.utcnow().replace(microsecond=0)
 
-        # Download the data using ulmo.
+        # Download the data using ulmo. A year at a time, so a new site doesn't
+        # ask for its whole history in one request (and hold it in memory).
         print(f"Harvesting NWIS site {site_code}.")
-        data = nwis.get_record(sites=site_code,
-                               service='iv',
-                               start=start.strftime("%Y-%m-%d"),
-                               end=end.strftime("%Y-%m-%d"))
-
-        # If nothing was returned, we're done.
-        if data.empty:
+        committed = False
+        for chunk_start, chunk_end in _year_ranges(start, end):
+            data = nwis.get_record(sites=site_code,
+                                   service='iv',
+                                   start=chunk_start.strftime("%Y-%m-%d"),
+                                   end=chunk_end.strftime("%Y-%m-%d"))
+            # If nothing was returned, move on.
+            if data.empty:
+                continue
+            data = self._clean_record(data, tz)
+            # If the file already exists, and we used its final datetime as
+            # the start date, for some reason, sometimes the data return gives
+            # data just before the start date. So, we need to filter that out
+            # if it exists. The same goes for the chunk before this one.
+            if last_server_time is not None:
+                data = data[data['datetime'] > last_server_time]
+                data.reset_index(drop=True, inplace=True)
+            if data.empty:
+                continue
+            # Parameters that weren't measured this time are left empty, so
+            # the rows can still be appended to the file.
+            if server_df is not None and \
+                    set(data.columns) <= set(server_df.columns):
+                data = data.reindex(columns=server_df.columns)
+            # We update the .csv files on the server with the new data.
+            commit_csv(file_path, data, server_df,
+                       to_csv_args={'date_format': '%Y-%m-%d %H:%M:%S'},
+                       old_header_only=True)
+            committed = True
+            server_df = open_csv(file_path, args={'nrows': 0, }, lock=True)
+            last_server_time = data['datetime'].max()
+        if not committed:
             print(f"No new data available for NWIS site {site_code}.\n")
-            return
-        # Otherwise, we examine the data.
-        # If data exists, first drop qa/qc columns and 'site_no' column
-        droplist = ['site_no']
-        skipped_parameters = []
-        for column in data.columns:
-            if column not in list(self.param_df.index):
-                droplist.append(column)
-                skipped_parameters.append(column)
-            if '_cd' in column:
-                droplist.append(column)
-            if 'discontinued' in column:
-                droplist.append(column)
-                skipped_parameters.append(column)
+
+    def _clean_record(self, data, tz):
+        """
+        Get a record returned by NWIS ready to be written to the csv.
+
+        @param data The DataFrame returned by nwis.get_record.
+        @param tz The timezone to convert the datetimes to.
+        @return The mapped parameter columns and a naive local datetime
+                column.
+        """
+        # First drop qa/qc columns and 'site_no' column
+        columns = data.columns
+        in_mapper = columns.isin(self.param_df.index)
+        discontinued = columns.str.contains('discontinued', regex=False)
+        qa_codes = columns.str.contains('_cd', regex=False)
+        keep = in_mapper & ~discontinued & ~qa_codes & (columns != 'site_no')
+        skipped_parameters = columns[~in_mapper | discontinued].tolist()
         vprint(f"skipped parameters: {skipped_parameters}. To keep these, "
                "add them to the NWIS mapper")
-        data.drop(columns=droplist, inplace=True, errors='ignore')
-        mapper = {'datetime': 'datetime'}
-        for column in data.columns:
-            mapper.update({column: self.param_df["clean_name"][column]})
-
-        data.rename(columns=mapper, inplace=True)
+        data.drop(columns=columns[~keep], inplace=True)
+        data.rename(columns=self.param_df["clean_name"].to_dict(),
+                    inplace=True)
 
         # Drop any potential duplicates (just in case).
         # Only drop duplicate INDEX, not duplicate values
-        data = data[~data.index.duplicated(keep='first')]
-        # Move datetime to its own column and then reset index
-        data['datetime'] = data.index
-        data.reset_index(drop=True, inplace=True)
-        # localize datetime column
-        data['datetime'] = data['datetime'].dt.tz_convert(tz)
-        data['datetime'] = data['datetime'].dt.tz_localize(None)
-        # If the file already exists, and we used its final datetime as the
-        # start date, for some reason, sometimes the data return gives data
-        # just before the start date. So, we need to filter that out if it
-        # exists.
-        if os.path.isfile(file_path):
-            data = data[data['datetime'] > last_server_time]
-            data.reset_index(drop=True, inplace=True)
-
-        # We update the .csv files on the server if we actually got new data.
-        if not data.empty:
-            commit_csv(file_path, data, server_df,
-                       to_csv_args={'date_format': '%Y-%m-%d %H:%M:%S'})
+        if data.index.is_monotonic_increasing:
+            # The returns are sorted, so any repeats sit next to each other
+            # and comparing neighbours is enough.
+            times = data.index.asi8
+            unique = np.empty(len(times), dtype=bool)
+            unique[:1] = True
+            np.not_equal(times[1:], times[:-1], out=unique[1:])
+            data = data[unique]
         else:
-            print(f"No new data available for {file_path}.\n")
+            data = data[~data.index.duplicated(keep='first')]
+        # Localize the datetime index and move it to its own column
+        data.index = data.index.tz_convert(tz).tz_localize(None)
+        return data.reset_index(names='datetime')
 
     def ingest(self, feeder_db_con, update_equipment_jsons):
         """
@@ -147,14 +201,18 @@ class NwisDataSource(DataSource):
         site_code = self.site_code
         file_name = f'nwis_{site_code}.csv'
         file_path = os.path.join(local_base_path, file_name)
-        # Create a DataFrame of the file.
-        args = {'float_precision': 'high', }
+        # Create a DataFrame of the file. The datetimes are parsed while
+        # reading rather than in a second pass.
+        args = {'float_precision': 'high', 'parse_dates': ['datetime']}
         df = open_csv(file_path, args=args, lock=True)
 
         # Rename datetime column to timestamp for compatibiltiy with general
         # ingestion
-        df['timestamp'] = pd.to_datetime(df['datetime'])
-        df.drop(columns='datetime', inplace=True)
+        df.rename(columns={'datetime': 'timestamp'}, inplace=True)
+        if not pd.api.types.is_datetime64_any_dtype(df['timestamp']):
+            # Something in the column couldn't be parsed on read
+            df['timestamp'] = pd.to_datetime(df['timestamp'],
+                                             format='%Y-%m-%d %H:%M:%S')
         df.sort_values(by='timestamp', inplace=True)
         df.reset_index(drop=True, inplace=True)
 
@@ -197,30 +255,32 @@ class NwisDataSource(DataSource):
             read_or_start_data_to_equipment_json(data_to_equipment_map_file,
                                                  equipment)
 
-            # Setup mappers with column names for lookup
-            lookup_df = self.param_df.set_index("clean_name")
-
-            for column_name in new_cols:
-                if column_name in col_list:
-                    continue
-                variable_domain_cv = "instrumentMeasurement"
-                variable_term = lookup_df['cv_term'][column_name]
-                unit = lookup_df['cv_unit'][column_name]
-                expose_as_datastream = True
-                if variable_term is None:
-                    continue
-                data_to_equip.append(
-                    gen_data_to_equipment_entry(
-                        column_name=column_name,
-                        var_domain_cv=variable_domain_cv,
-                        acquiring_instrument_uuid=dev_uuid,
-                        variable_term=variable_term,
-                        expose_as_ds=expose_as_datastream,
-                        units_term=unit))
-            # Write the new files
-            print("Writing equipment jsons.")
-            check_diff_and_write_new(data_to_equip, data_to_equipment_map_file)
-            check_diff_and_write_new([equipment], equip_file)
+            # Only columns that aren't mapped yet (and have a cv term) need
+            # a new entry
+            mapped_cols = set(col_list)
+            n_entries = len(data_to_equip)
+            data_to_equip.extend(
+                gen_data_to_equipment_entry(
+                    column_name=column_name,
+                    var_domain_cv="instrumentMeasurement",
+                    acquiring_instrument_uuid=dev_uuid,
+                    variable_term=self._cv_term[column_name],
+                    expose_as_ds=True,
+                    units_term=self._cv_unit[column_name])
+                for column_name in new_cols
+                if column_name not in mapped_cols
+                and self._cv_term[column_name] is not None)
+            # Write the new files, unless they're both there already and there
+            # weren't any new columns
+            if len(data_to_equip) == n_entries and \
+                    os.path.isfile(equip_file) and \
+                    os.path.isfile(data_to_equipment_map_file):
+                print("No new columns, skipping the equipment jsons.")
+            else:
+                print("Writing equipment jsons.")
+                check_diff_and_write_new(data_to_equip,
+                                         data_to_equipment_map_file)
+                check_diff_and_write_new([equipment], equip_file)
 
         # The rest of the ingestion is generic.
         general_timeseries_ingestion(feeder_db_con,
@@ -6,20 +6,48 @@ Module for NWIS data harvesting, ingestion, and processing.
 
 import os
 import datetime
+from functools import lru_cache
 from importlib.util import find_spec
+import filelock
+import numpy as np
 import pandas as pd
-from dataretrieval import nwis
-from odmx.support.file_utils import open_json, open_csv
+from odmx.support.file_utils import open_json, open_csv,\
+    get_last_timestamp_csv
 import odmx.support.db as db
 from odmx.abstract_data_source import DataSource
-from odmx.timeseries_ingestion import add_columns
+from odmx.timeseries_ingestion import add_columns, create_table
 from odmx.geochem_ingestion_core import fieldspecimen_child_sf_creation,\
-    sampleaction_routine, write_sample_results, feature_action
+    sampleaction_routine, write_sample_results, feature_action,\
+    prefetch_child_sampling_features, write_sample_results_many
 from odmx.harvesting import commit_csv
 from odmx.log import vprint
 import odmx.data_model as odmx
 
 mapper_path = find_spec("odmx.mappers").submodule_search_locations[0]
+# How many numeric results process() collects before writing them together.
+RESULTS_BATCH_SIZE = int(os.getenv("ODMX_RESULTS_BATCH_SIZE", "1000"))
+
+@lru_cache
+def _load_mappers():
+    """
+    Read the NWIS geochem parameter mapper and the USGS remark and value
+    qualifier code mappers. This only happens once per process.
+
+    @return The parameter mapper, the remark codes indexed by remark_cd and
+            the value qualifier codes indexed by val_qual_cd.
+    """
+    param_df = pd.DataFrame(open_json(f'{mapper_path}/nwis_geochem.json'))
+    remarks_df = pd.DataFrame(
+        open_json(f'{mapper_path}/usgs_remarks_to_censor_codes.json'))
+    remarks_df.set_index("remark_cd", inplace=True, verify_integrity=True)
+    vqc_df = pd.DataFrame(open_json(f'{mapper_path}/usgs_val_quals.json'))
+    vqc_df.set_index("val_qual_cd", inplace=True, verify_integrity=True)
+    return param_df, remarks_df, vqc_df
+
+# Sample metadata returned by qwdata that isn't a result
+_DROPPED_COLUMNS = {'site_no', 'sample_dt', 'sample_tm', 'sample_end_dt',
+                    'sample_end_tm', 'tu_id', 'body_part_id',
+                    'sample_lab_cm_txt'}
 
 class NwisGeochemDataSource(DataSource):
     """
@@ -35,80 +63,81 @@ class NwisGeochemDataSource(DataSource):
         self.data_source_path = 'nwis_geochem'
         self.site_code = site_code
         self.feeder_table = f'nwis_geochem_{site_code}'
-        self.param_df = pd.DataFrame(
-            open_json(f'{mapper_path}/nwis_geochem.json'))
-        self.remarks_df = pd.DataFrame(
-            open_json(f'{mapper_path}/usgs_remarks_to_censor_codes.json'))
-        self.remarks_df.set_index("remark_cd", inplace=True,
-                                  verify_integrity=True)
-        self.vqc_df = pd.DataFrame(
-            open_json(f'{mapper_path}/usgs_val_quals.json'))
-        self.vqc_df.set_index("val_qual_cd", inplace=True,
-                                  verify_integrity=True)
-
-#Need to try turning the string into a timestamp also
-    def apply_annotations(self, element):
+        param_df, self.remarks_df, self.vqc_df = _load_mappers()
+        # harvest and process re-index the parameter mapper in place, so each
+        # site gets its own copy. The code mappers are treated as read only.
+        self.param_df = param_df.copy()
+        # Plain dicts for the per value code lookups
+        self._censor_cvs = self.remarks_df["censor_cv"].to_dict()
+        self._val_qual_nms = self.vqc_df["val_qual_nm"].to_dict()
+
+    def apply_annotations_series(self, series):
         """
-        Function to parse USGS annotations (remarks and qualifier codes)
+        Parse USGS annotations (remarks and qualifier codes) in one column.
 
         This is intended for use in the ingestion step, with data read in from
         a csv as strings, and has been reworked with that in mind. It will not
-        work in the harvest step as written.
+        work in the harvest step as written. Plain numbers, nans and
+        timestamps are left as they are, everything else is split into
+        remark, value and qualifiers and rewritten as
+        `{censor}_{value}_vqc_qualifier_{name}...`.
+
+        @param series The column to annotate.
+        @return The annotated column, as strings.
         """
-        remark = None
-        qualifiers = None
-        value = None
-        if isinstance(element, (float, int)):
-            annotated = str(element)
-        elif element.strip() == "nan":
-            annotated = element.strip()
-        else:
-            element.strip()
-            try:
-                float(element)
-                annotated = str(element)
-            except ValueError:
-
-                try:
-                    datetime.datetime.strptime(element, '%Y-%m-%d %H:%M:%S')
-                    annotated = element
-                except ValueError:
-                    parts = element.split()
-                    if len(parts) == 2:
-                        try:
-                            float(parts[0])
-                            value, qualifiers = parts
-                        except:  # pylint: disable=bare-except
-                            remark, value = parts
-                    elif len(parts) == 3:
-                        remark, value, qualifiers = parts
-                    elif len(parts) == 1:
-                        # For present but not quantified, there's just a remark
-                        # I think this is the only case that would apply to
-                        remark = parts[0]
-                    else:
-                        raise ValueError(f"Too many parts to result {element}."
-                                         " Maximum is three: "
-                                         "remark, value, qualifiers")
-                    if value:
-                        annotated = value
-                    else:
-                        annotated = ''
-                    if remark:
-                        prefix = self.remarks_df["censor_cv"][remark]
-                        annotated = f'{prefix}_{annotated}'
-                    if qualifiers:
-                        postfix = ''
-                        for char in qualifiers:
-                            postfix += f'_qualifier_{self.vqc_df["val_qual_nm"][char]}'  # pylint: disable=line-too-long
-                        postfix.replace('__', '_')
-                        annotated += f'_vqc{postfix}'
+        # Missing cells come back as NaN, which reads as 'nan' here
+        annotated = series.astype(str)
+        plain = (annotated.str.strip() == 'nan') \
+            | pd.to_numeric(annotated, errors='coerce').notna() \
+            | pd.to_datetime(annotated, format='%Y-%m-%d %H:%M:%S',
+                             errors='coerce').notna()
+        to_parse = annotated[~plain]
+        if to_parse.empty:
+            return annotated
+        parts = to_parse.str.split(expand=True)
+        n_parts = parts.notna().sum(axis=1)
+        if ((n_parts < 1) | (n_parts > 3)).any():
+            element = to_parse[(n_parts < 1) | (n_parts > 3)].iloc[0]
+            raise ValueError(f"Too many parts to result {element}."
+                             " Maximum is three: "
+                             "remark, value, qualifiers")
+        parts = parts.reindex(columns=range(3))
+        # With two parts, a leading number means there is no remark.
+        no_remark = (n_parts == 2) \
+            & pd.to_numeric(parts[0], errors='coerce').notna()
+        remark = parts[0].where(~no_remark)
+        value = parts[1].where(n_parts > 1).mask(no_remark, parts[0])
+        qualifiers = parts[2].mask(no_remark, parts[1])
+        # For present but not quantified, there's just a remark, so no value
+        result = value.fillna('')
+        # There are only a handful of distinct codes, so they are made
+        # categorical and each category is looked up once.
+        has_remark = remark.notna()
+        if has_remark.any():
+            remarks = remark[has_remark].astype('category')
+            censor_cvs = {code: self._censor_cvs[code]
+                          for code in remarks.cat.categories}
+            prefix = remarks.map(censor_cvs).astype(object)
+            result[has_remark] = prefix + '_' + result[has_remark]
+        has_qualifiers = qualifiers.notna()
+        if has_qualifiers.any():
+            codes = qualifiers[has_qualifiers].astype('category')
+            postfixes = {
+                chars: ''.join(f'_qualifier_{self._val_qual_nms[char]}'
+                               for char in chars)
+                for chars in codes.cat.categories
+            }
+            result[has_qualifiers] += \
+                '_vqc' + codes.map(postfixes).astype(object)
+        annotated[~plain] = result
         return annotated
 
     def harvest(self):
         """
         Harvest NWIS data from the API and save it to a .csv on our servers.
         """
+        # Only harvesting talks to the USGS services
+        from dataretrieval import nwis  # pylint: disable=import-outside-toplevel
         # Set USGS code to param_df index for easier lookup
         self.param_df.set_index("id", inplace=True, verify_integrity=True)
 
@@ -127,15 +156,14 @@ class NwisGeochemDataSource(DataSource):
         # If it does, we want to find only new data.
         server_df = None
         if os.path.isfile(file_path):
-            # Grab the data from the server.
-            args = {'parse_dates': [0], 'header': [0,1]}
+            # Only the header of the existing data is needed, the latest
+            # timestamp is read from the last line.
+            args = {'header': [0,1], 'nrows': 0}
             server_df = open_csv(file_path, args=args, lock=True)
-            # Find the latest timestamp.
-            last_server_time = server_df['datetime'].max()['timestamp']
-            if isinstance(last_server_time, str):
-                last_server_time = datetime.datetime.strptime(
-                    last_server_time, '%Y-%m-%d %H:%M:%S'
-                )
+            last_server_time = get_last_timestamp_csv(
+                file_path,
+                timestamp_index=server_df.columns.get_loc(
+                    ('datetime', 'timestamp'))).to_pydatetime()
             # Add a minute to it so that we don't get it in the return (the
             # data is never so granular anyway).
             start = last_server_time + datetime.timedelta(minutes=1)
@@ -148,6 +176,19 @@ class NwisGeochemDataSource(DataSource):
             start = datetime.datetime(1900, 1, 2)
             end = datetime.datetime.utcnow().replace(microsecond=0)
 
+        # Water quality samples are few and far between. If the latest one we
+        # have is less than a day old, don't ask NWIS again yet. The csv holds
+        # naive site times, so that one is put in the site's timezone before
+        # comparing it with the current time.
+        if server_df is not None:
+            last_sample = pd.Timestamp(last_server_time).tz_localize(
+                tz, ambiguous=True, nonexistent='shift_forward')
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if now - last_sample < datetime.timedelta(days=1):
+                print(f"Latest sample for NWIS site {site_code} is from "
+                      f"{last_server_time}, not checking for new data.\n")
+                return
+
         # Download the data using ulmo.
         print(f"Harvesting NWIS site {site_code}.")
         data = nwis.get_record(sites=site_code,
@@ -160,37 +201,29 @@ class NwisGeochemDataSource(DataSource):
             print(f"No new data available for NWIS site {site_code}.\n")
             return
         # Otherwise, we examine the data.
-        # If data exists, first drop qa/qc columns and 'site_no' column
-        droplist = ['site_no', 'sample_dt', 'sample_tm', 'sample_end_dt',
-                    'sample_end_tm', 'tu_id', 'body_part_id',
-                    'sample_lab_cm_txt']
-        skipped_parameters = []
-        for column in data.columns:
-            if column not in list(self.param_df.index):
-                droplist.append(column)
-                skipped_parameters.append(column)
+        # If data exists, only keep the mapped parameters, which leaves out
+        # the qa/qc columns and 'site_no'
+        clean_names = self.param_df["clean_name"].to_dict()
+        cv_units = self.param_df["cv_unit"].to_dict()
+        skipped_parameters = [column for column in data.columns
+                              if column not in clean_names]
         vprint(f"skipped parameters: {skipped_parameters}. To keep these, "
                "add them to the NWIS geochem mapper")
-        data.drop(columns=droplist, inplace=True, errors='ignore')
-        mapper = {'datetime': 'datetime'}
-        units = []
-        for column in data.columns:
-            mapper.update({column: self.param_df["clean_name"][column]})
-            units.append(self.param_df["cv_unit"][column])
-
-        # Move datetime to its own column and then reset index
-        data['datetime'] = data.index
+        keep = [column for column in data.columns
+                if column in clean_names and column not in _DROPPED_COLUMNS]
+        units = [cv_units[column] for column in keep]
+        data = data[keep].rename(columns=clean_names)
+
+        # Localize the datetime index, then move it to its own column and
+        # reset the index
+        local_times = data.index.tz_convert(tz).tz_localize(None)
         data.reset_index(drop=True, inplace=True)
+        data['datetime'] = local_times
 
-        # localize datetime column
-        data['datetime'] = data['datetime'].dt.tz_convert(tz)
-        data['datetime'] = data['datetime'].dt.tz_localize(None)
-
-        # Rename columns and add units row to header
-        # Has to happen after datetime conversion because renaming doesn't work
-        # on MultiIndex, and empty unit for datetime breaks datetime operations
+        # Add units row to header
+        # Has to happen after datetime conversion because empty unit for
+        # datetime breaks datetime operations
         units.append('timestamp')
-        data.rename(columns=mapper, inplace=True)
         new_header = [list(data.columns), units]
         data.columns = new_header
 
@@ -200,7 +233,8 @@ class NwisGeochemDataSource(DataSource):
             # print(f"New headers are: {list(data.columns)}")
             # print(f"Old headers were: {list(server_df.columns)}")
             commit_csv(file_path, data, server_df,
-                       to_csv_args={'date_format': '%Y-%m-%d %H:%M:%S'})
+                       to_csv_args={'date_format': '%Y-%m-%d %H:%M:%S'},
+                       old_header_only=True)
         else:
             print(f"No new data available for {file_path}.\n")
 
@@ -214,12 +248,65 @@ class NwisGeochemDataSource(DataSource):
         site_code = self.site_code
         file_name = f'nwis_geochem_{site_code}.csv'
         file_path = os.path.join(local_base_path, file_name)
-        # Create a DataFrame of the file.
-        args = {'float_precision': 'high', 'header': [0,1]}
-        df = open_csv(file_path, args=args, lock=True)
+        # The two row header is read on its own, and the data after it is
+        # read and ingested a chunk at a time so the whole file never has to
+        # be in memory. The rows are in time order, so each chunk only adds
+        # what is newer than the feeder table.
+        header = open_csv(file_path, args={'header': [0,1], 'nrows': 0},
+                          lock=True).columns
+        # Everything is annotated and stored as text, so the values are read
+        # as strings rather than inferring and converting numbers.
+        args = {'dtype': str, 'header': None, 'skiprows': 2,
+                'names': list(range(len(header))), 'chunksize': 100_000}
+        # The feeder table is only asked for its latest timestamp once, after
+        # that it's whatever the previous chunk added.
+        last_time = self._get_feeder_last_time(feeder_db_con)
+        # Hold the lock for the whole read, not just while opening the file
+        with filelock.FileLock(f'{file_path}.lock', timeout=300), \
+                open_csv(file_path, args=args) as reader:
+            for df in reader:
+                df.columns = header
+                last_time = self._ingest_chunk(feeder_db_con, df, last_time)
+
+    def _get_feeder_last_time(self, feeder_db_con):
+        """
+        Find the latest timestamp in the feeder table.
 
+        @param feeder_db_con The feeder database connection.
+        @return The latest timestamp, or None if the table doesn't exist or
+                has no data in it.
+        """
+        if not db.does_table_exist(feeder_db_con, self.feeder_table):
+            return None
+        # The timestamp column is text, and its first row holds the units
+        # rather than a time, so only rows that start with a date count.
+        query = f'''
+            SELECT timestamp FROM
+                {db.quote_id(feeder_db_con,
+                           self.feeder_table)}
+                WHERE timestamp ~ '^[0-9]'
+                ORDER BY timestamp DESC LIMIT 1
+        '''
+        result = feeder_db_con.execute(query).fetchone()
+        # However, the table could exist but be empty (odd edge case that
+        # should only happen if the table is created, but then there's an
+        # ingestion error, and we try to ingest again).
+        if result is None:
+            return None
+        return pd.to_datetime(result[0])
+
+    def _ingest_chunk(self, feeder_db_con, df, last_time):
+        """
+        Ingest one chunk of the harvested NWIS data into the feeder table.
+
+        @param feeder_db_con The feeder database connection.
+        @param df The chunk, with the two row header as its columns.
+        @param last_time The latest timestamp in the feeder table, or None if
+                         it has no data yet.
+        @return The latest timestamp in the feeder table after this chunk.
+        """
         # clean up remarks and qualifier codes in results
-        df = df.applymap(self.apply_annotations)
+        df = df.apply(self.apply_annotations_series)
 
         # Rename datetime column to timestamp to match convention
         df['timestamp'] = pd.to_datetime(df[('datetime', 'timestamp')])
@@ -227,13 +314,12 @@ class NwisGeochemDataSource(DataSource):
         df.sort_values(by='timestamp', inplace=True)
         df.reset_index(drop=True, inplace=True)
 
-        # Split header back into two rows
+        # Split header back into two rows. The units only go in as the first
+        # row of the table, not with every chunk.
         headers = [col[0] for col in list(df.columns)]
-        units = [col[1] for col in list(df.columns)]
-
-        df.columns = headers
-        df.loc[-1] = units
-        df = df.sort_index().reset_index(drop=True)
+        units = pd.DataFrame([[col[1] for col in list(df.columns)]],
+                             columns=headers)
+        df = df.set_axis(headers, axis=1)
 
         # Create feeder table
         # This is very similar to the code for general_timeseries_ingestion
@@ -248,6 +334,15 @@ class NwisGeochemDataSource(DataSource):
         cols.insert(0, cols.pop(cols.index('timestamp')))
         df = df.loc[:, cols]
 
+        # Only add what is newer than the feeder table.
+        if last_time is not None:
+            df = df[df['timestamp'] > last_time]
+            # If the DataFrame is empty, there's no new data to ingest.
+            if df.empty:
+                print("No new data to ingest.\n")
+                return last_time
+        new_last_time = df['timestamp'].max()
+
         # With that nonsense out of the way, check to see if the table exists
         #  in the database.
         print(f"Checking to see if \"{self.feeder_table}\" exists"
@@ -258,15 +353,11 @@ class NwisGeochemDataSource(DataSource):
             print(f"\"{self.feeder_table}\" doesn't exist yet."
                   " Creating it.")
             # Since pandas.to_sql doesn't support primary key creation, we need
-            # to handle that. First we make the table in PostgreSQL.
-            query = f'''
-                CREATE TABLE {db.quote_id(feeder_db_con,
-                               self.feeder_table)}
-                    (index SERIAL PRIMARY KEY)
-            '''
-            feeder_db_con.execute(query)
-            add_columns(feeder_db_con, self.feeder_table,
-                    df.columns.tolist(), col_type='text', override_all=True)
+            # to handle that. The table is made in PostgreSQL with all of its
+            # columns in one statement.
+            create_table(feeder_db_con, self.feeder_table,
+                         df.columns.tolist(), col_type='text',
+                         override_all=True)
         # If it does exist, we only want to add new data to it.
         else:
             # First check if we added any columns
@@ -279,32 +370,16 @@ class NwisGeochemDataSource(DataSource):
                 print(f"Adding new columns '{new_columns}'")
                 add_columns(feeder_db_con, self.feeder_table,
                             new_columns, col_type='text', override_all=True)
-            query = f'''
-                SELECT timestamp FROM
-                    {db.quote_id(feeder_db_con,
-                               self.feeder_table)}
-                    ORDER BY timestamp DESC LIMIT 1
-            '''
-            result = feeder_db_con.execute(query).fetchone()
-            # However, the table could exist but be empty (odd edge case that
-            # should only happen if the table is created, but then there's an
-            # ingestion error, and we try to ingest again).
-            if result is not None:
-                last_time = result[0]
-                # TODO not sure why this is sometimes a string
-                if isinstance(df['timestamp'][0], str):
-                    df['timestamp'] = pd.to_datetime(df['timestamp'])
-                df = df[df['timestamp'] > last_time]
-                # If the DataFrame is empty, there's no new data to ingest.
-                if df.empty:
-                    print("No new data to ingest.\n")
-                    return
-            else:
+            if last_time is None:
                 print(f"\"{self.feeder_table}\" is empty. Adding"
                       " to it.")
+        # A table with no data yet gets the units as its first row.
+        if last_time is None:
+            df = pd.concat([units[df.columns], df], ignore_index=True)
 
         print(f"Populating {self.feeder_table}.")
         db.insert_many_df(feeder_db_con, self.feeder_table, df, upsert=False)
+        return new_last_time
 
 
     def process(self, feeder_db_con, odmx_db_con, sampling_feature_code):
@@ -344,31 +419,91 @@ class NwisGeochemDataSource(DataSource):
         feeder_tables = [x for x in feeder_tables \
                          if x.startswith('nwis_geochem_')]
         vprint(f"Using feeder tables {feeder_tables}")
+        # sf_code=feeder_table.replace('nwis_geochem_','NWIS-')
+        # see if we have this sf in our sampling features. This doesn't depend
+        # on the feeder table, so look it up once.
+        sampling_feature = \
+            odmx.read_sampling_features_one_or_none(
+                odmx_db_con, sampling_feature_code=sampling_feature_code)
+        if not sampling_feature:
+            print('did not find an associated sampling feature with the '
+                  'feeder table')
+        # we get the extension id for usgs properties. It is the same for
+        # every result, so read it once rather than once per sample.
+        property_name = 'usgs_value_qualifier_code'
+        usgs_property_id = odmx.read_extension_properties_one(
+            odmx_db_con,
+            property_name=property_name).property_id
+        assert usgs_property_id is not None
+        vprint('usgs_property_id :', usgs_property_id)
+        # The names of the remark and value qualifier codes that annotated
+        # values are matched against, they don't change from cell to cell.
+        measurement_qualifiers = list(self.remarks_df["censor_cv"])
+        vqc_qualifiers = list(self.vqc_df["val_qual_nm"])
+        # The units and variables only depend on the column, so each distinct
+        # one is read from the database once.
+        @lru_cache(maxsize=None)
+        def read_units(term):
+            return odmx.read_cv_units_one_or_none(odmx_db_con, term=term)
+
+        @lru_cache(maxsize=None)
+        def read_variable(variable_term):
+            return odmx.read_variables_one_or_none(
+                odmx_db_con, variable_term=variable_term)
+        cv_terms = self.param_df["cv_term"].to_dict()
+        # The samples that were created by earlier runs are looked up in one
+        # go instead of once per row.
+        cached = prefetch_child_sampling_features(
+            odmx_db_con, f'{sampling_feature_code}_geochem')
+        vprint(f'Found {cached} existing samples for {sampling_feature_code}')
+        # The metadata below is the same for every feeder table, sample and
+        # result, so it is set up once.
+        specimen_collection_cv = 'analysisReport'
+        data_file_name = f'nwis_geochem_{site_code}.csv'
+        data_file_path = os.path.join(local_base_path, data_file_name)
+        analyst_name = 'USGS Analyst'
+        analysis_date = datetime.datetime.utcnow()
+        analysis_timezone = 'UTC'
+        # right now the affiliation is hardcoded.. We need to look this
+        # up by organization (TODO)
+        affiliation_id = 1
+        relation = 'wasCollectedAt'
+        specimen_type_cv = 'grab'
+        specimen_medium_cv = 'liquidAqueous'
+        # Set placeholder variables for the write sample results routine
+        timezone = 'est'
+        depth_m = None
+        passed_result_id = None
+        data_type = 'na'
+        stddev = False
         # we convert the name of the feeder table into the associated sampling
         # feature table
         print('iterating through feeder tables')
         for feeder_table in feeder_tables:
-            print(feeder_table)
-            # sf_code=feeder_table.replace('nwis_geochem_','NWIS-')
-            # see if we have this sf in our sampling features
-            sampling_feature = \
-                odmx.read_sampling_features_one_or_none(
-                    odmx_db_con, sampling_feature_code=sampling_feature_code)
             print(feeder_table, sampling_feature)
-            if not sampling_feature:
-                print('did not find an associated sampling feature with the '
-                      'feeder table')
+            # we read the data first, so that a table without any samples
+            # (only the units row) doesn't create an empty specimen collection
+            # and analysis action
+            feeder_table_columns = db.get_columns(feeder_db_con,feeder_table)
+            data_df = db.query_df(feeder_db_con,feeder_table)
+            data_df_rows = data_df.shape[0]
+            data_df_columns = data_df.shape[1]
+            # The loops below index single cells, which is much cheaper on
+            # a plain array than through the DataFrame.
+            values = data_df.to_numpy()
+
+            print('rows,columns ', data_df_rows, data_df_columns)
+            if data_df_rows <= 1:
+                print(f'No samples in {feeder_table}, skipping it.')
+                continue
             # We create a specimen collection for this entry and will associate
             # all sampling features with it.
             print("Creating a new specimen collection.")
-            specimen_collection_cv = 'analysisReport'
             specimen_collection_note = \
                 ('Analysis report from USGS for samples '
                  f'from{sampling_feature.sampling_feature_code}')
             # TODO figure out what this is supposesd to be and do a lookup
             #specimen_collection_parent_id = 1
-            data_file_name = f'nwis_geochem_{site_code}.csv'
-            data_file_path = os.path.join(local_base_path, data_file_name)
             specimen_collection_id = odmx.write_specimen_collection(
                 odmx_db_con,
                 specimen_collection_cv = specimen_collection_cv,
@@ -377,13 +512,7 @@ class NwisGeochemDataSource(DataSource):
                 specimen_collection_note = specimen_collection_note,
             )
             # Write to the `actions`, `action_by`, and `related_actions`
-            # tables. Start by defining metadata info.
-            analyst_name = 'USGS Analyst'
-            analysis_date = datetime.datetime.utcnow()
-            analysis_timezone = 'UTC'
-            # right now the affiliation is hardcoded.. We need to look this
-            # up by organization (TODO)
-            affiliation_id = 1
+            # tables.
             action_id = sampleaction_routine(odmx_db_con,
                     analyst_name,affiliation_id, analysis_date,
                                         analysis_timezone, data_file_path)
@@ -395,36 +524,37 @@ class NwisGeochemDataSource(DataSource):
             # sampling feature
             # b) we create results for each sample
 
-            # we read the data
-            feeder_table_columns = db.get_columns(feeder_db_con,feeder_table)
-            data_df = db.query_df(feeder_db_con,feeder_table)
-            data_df_rows = data_df.shape[0]
-            data_df_columns = data_df.shape[1]
-
-            print('rows,columns ', data_df_rows, data_df_columns)
-
-            parameter_units = data_df.iloc[0]
+            parameter_units = values[0]
             # if we want to see what units are associated we can print this out
             # for index in feeder_table_columns:
             #      print(index,' : ',parameter_units[index])
             # we iterate over tables from 1 (first one with data) to the last
             # one we use the timestamp to create a sample name, which will be
             # parentsamplingfeaturename_geochem_date
-            for index in range(1, data_df_rows):
-                timestamp = datetime.datetime.strptime(data_df.iloc[index][1],
-                                                       '%Y-%m-%d %H:%M:%S')
-                sample_date = data_df.iloc[index][1].replace(' ',
-                                                           '-').replace(':',
-                                                                        '-')
+            # Work out which values are plain numbers for the whole table at
+            # once, rather than trying float() on every cell in the loop.
+            is_numeric = data_df.iloc[1:, 2:].apply(
+                pd.to_numeric, errors='coerce').notna().to_numpy()
+            # USGS results are sparse, most of the cells in a row are nan.
+            not_nan = values[1:] != 'nan'
+            # Parse the sample times and build their names for the whole
+            # table up front as well.
+            sample_times = pd.to_datetime(data_df.iloc[1:, 1],
+                                          format='%Y-%m-%d %H:%M:%S',
+                                          cache=True)
+            timestamps = sample_times.dt.to_pydatetime()
+            sample_dates = sample_times.dt.strftime(
+                '%Y-%m-%d-%H-%M-%S').to_numpy()
+            sample_results = []
+            for row_number, row in enumerate(values[1:]):
+                timestamp = timestamps[row_number]
+                sample_date = sample_dates[row_number]
                 collected_sf_code = (f'{sampling_feature_code}'
                                      f'_geochem{sample_date}')
-                relation = 'wasCollectedAt'
-                # print(index,data_df.iloc[index][1],collected_sf_code)
+                # print(row[1],collected_sf_code)
                 # we now have the name of the sample and the relation
                 # we will now create the sample in our ODMX database
                 # within this call we also create the entry in specimens
-                specimen_type_cv = 'grab'
-                specimen_medium_cv = 'liquidAqueous'
                 specimen_sf_id, did_it_exist = fieldspecimen_child_sf_creation(
                          odmx_db_con, timestamp, sampling_feature_code,
                          collected_sf_code, relation, specimen_type_cv,
@@ -444,6 +574,13 @@ class NwisGeochemDataSource(DataSource):
 
                 feature_action_id = feature_action(odmx_db_con, action_id,
                                                specimen_sf_id)
+                # The relation is the same for every result of the sample
+                related_features_relation_id = \
+                    odmx.read_related_features_one_or_none(
+                        odmx_db_con,
+                        sampling_feature_id=specimen_sf_id).relation_id
+                vprint('related features relation id :',
+                       related_features_relation_id)
                 # Now we run through the entries in the row. Note that the USGS
                 # can have a lot of results, but for most of the time they are
                 # nan so we see if they are not nan and then we process them
@@ -452,164 +589,127 @@ class NwisGeochemDataSource(DataSource):
                 # (which we already read), which is why we start at 2
                 need_to_add = []
 
-                # we get the extension id for usgs properties
-                property_name = 'usgs_value_qualifier_code'
-                with odmx_db_con.transaction():
-                    con = odmx_db_con
-                    usgs_property_id = odmx.read_extension_properties_one(
-                    con,
-                    property_name=property_name).property_id
-                    assert usgs_property_id is not None
-                    print('usgs_property_id :', usgs_property_id)
-
-
-                for rowind in range(2, data_df_columns):
-                    rowvalue = data_df.iloc[index][rowind]
-                    if not rowvalue == 'nan':
-                        # CV has already been expanded, do still need to add
-                        # attributes for fltered/unfiltered and lab/field though
-                        clean_name = feeder_table_columns[rowind]
-                        odmx_cv_term = self.param_df["cv_term"][clean_name]
-                        # we already mapped the units to our own unit cvs
-                        usgs_unit = parameter_units[rowind]
-                        # we have two cases.
-                        # First, the value is numeric, in which case the
-                        # parsing is easy. Second, the value has text in it,
-                        # in which case we need to do some more complex parsing
-                        # note that we also want to catch scientific notations
-                        # so we use float to test the value
-                        try:
-                            float(rowvalue)
-                            is_float = True
-                        except ValueError:
-                            is_float = False
-                        if is_float:
-                            print(' ')
-                            print(f'Parsing {odmx_cv_term} {usgs_unit} '
-                                  f'{rowvalue}')
-                            # we have all the data we need to parse
-                            # we first look up the parameter id and the units
-                            # id and then we create a result associated with
-                            # the sample
-                            odmx_unit = odmx.read_cv_units_one_or_none(
-                                odmx_db_con, term=usgs_unit)
-                            print('odmx_unit : ', odmx_unit)
-                            units_id = odmx_unit.units_id
-                            odmx_variable = \
-                                odmx.read_variables_one_or_none(
-                                    odmx_db_con, variable_term=odmx_cv_term)
-                            if odmx_variable is None:
-                                need_to_add.append((odmx_cv_term, clean_name))
-                                continue
-                            print('odmx_variable :', odmx_variable)
-                            variable_id = odmx_variable.variable_id
-                            #now we know the variable and units and the
-                            #value. We are ready to create a result and
-                            #associated values in the odmx database
-                            related_features_relation_id = \
-                                odmx.read_related_features_one_or_none(
-                                    odmx_db_con,
-                                    sampling_feature_id = \
-                                        specimen_sf_id).relation_id
-                            print('related features relation id :',
-                                  related_features_relation_id)
-
-                            # now we write the results
-                            # Set placeholder variables for the write sample
-                            # results routine
-                            timezone = 'est'
-                            depth_m = None
-                            passed_result_id = None
-                            data_type = 'na'
-                            stddev = False
-                            # result_id  tells us the id in the results table
-                            # so we can add other values
-                            censor_code=''
-                            quality_code=''
-                            result_id = write_sample_results(odmx_db_con,
-                                          units_id,variable_id, rowvalue,
+                # Only the cells that aren't nan are visited, they are
+                # picked out of the precomputed mask.
+                for rowind in np.flatnonzero(not_nan[row_number, 2:]) + 2:
+                    rowvalue = row[rowind]
+                    # CV has already been expanded, do still need to add
+                    # attributes for fltered/unfiltered and lab/field though
+                    clean_name = feeder_table_columns[rowind]
+                    odmx_cv_term = cv_terms[clean_name]
+                    # we already mapped the units to our own unit cvs
+                    usgs_unit = parameter_units[rowind]
+                    # we have two cases.
+                    # First, the value is numeric, in which case the
+                    # parsing is easy. Second, the value has text in it,
+                    # in which case we need to do some more complex parsing
+                    # note that scientific notation counts as numeric too
+                    if is_numeric[row_number, rowind - 2]:
+                        vprint(f'Parsing {odmx_cv_term} {usgs_unit} '
+                               f'{rowvalue}')
+                        # we have all the data we need to parse
+                        # we first look up the parameter id and the units
+                        # id and then we create a result associated with
+                        # the sample
+                        odmx_unit = read_units(usgs_unit)
+                        vprint('odmx_unit : ', odmx_unit)
+                        units_id = odmx_unit.units_id
+                        odmx_variable = read_variable(odmx_cv_term)
+                        if odmx_variable is None:
+                            need_to_add.append((odmx_cv_term, clean_name))
+                            continue
+                        vprint('odmx_variable :', odmx_variable)
+                        variable_id = odmx_variable.variable_id
+                        #now we know the variable and units and the
+                        #value. We are ready to create a result and
+                        #associated values in the odmx database
+                        # now we write the results
+                        censor_code=''
+                        quality_code=''
+                        # Plain readings are buffered and written in bulk
+                        sample_results.append((units_id, variable_id,
+                                               rowvalue, timestamp, timezone,
+                                               depth_m, feature_action_id,
+                                               quality_code))
+                        if len(sample_results) >= RESULTS_BATCH_SIZE:
+                            write_sample_results_many(odmx_db_con,
+                                                      sample_results)
+                            sample_results = []
+                    else:
+                        # these values needs to be tr
+                        # first we find the initial cases whoch quantify it
+                        # we have two cases we can have
+                        # - zero or one  measurement qualifier
+                        # - zero, one or more vqc qualifie
+                        vprint('we have a non matching value: ')
+                        vprint('rowvalue :', rowvalue)
+
+                        vqc_qualifier=False
+                        measurement_qualifier=0
+                        vqc_qualifier_case=0
+                        mquals=[]
+                        vquals=[]
+                        mcount=0
+                        vcount=0
+                        for item in measurement_qualifiers:
+                            if item in rowvalue:
+                                mcount=mcount+1
+                                mquals.append(item)
+                        if 'vqc_qualifier' in rowvalue:
+                            vqc_qualifier=True
+                            # we try to match rowvalue with the entries
+                            for item in vqc_qualifiers:
+                                if item in rowvalue:
+                                    vcount=vcount+1
+                                    vquals.append(item)
+                        # we have an issue that we do not have a match
+                        if vqc_qualifier is True and vcount==0:
+                            print(' error  - we have an undefined vqc_code')
+                            exit('undefined vqc_code')
+                        if mcount==0 and vcount==0:
+                            print(' error  - mcount and vcount both 0')
+                            print(' rowvalue: ',rowvalue)
+                            exit('no matches')
+                        # we now iterate over the arrays and write the entries
+                        # we also still need to extract the value
+                        # we also write the value (optionally)
+                        news=rowvalue.replace('vqc_qualifier_','').replace('qualifier_','')
+                        for item in measurement_qualifiers:
+                            news=news.replace(item,'')
+                        for item in vqc_qualifiers:
+                            news=news.replace(item,'')
+                        news=news.replace('_','').replace('_','')
+                        # print('news',news,'rowvalue',rowvalue)
+                        # now we will do the following
+                        # we will write a value
+                        censor_code = ''
+                        # as this data has issues we give it a flag of marginal so that
+                        # we can decide whether to keep it
+                        quality_code='marginal'
+                        if news != '':
+                            if(float(news)):
+                                result_written_id = write_sample_results(odmx_db_con,
+                                          units_id,variable_id, news,
                                           timestamp, timezone, depth_m,
                                           data_type, passed_result_id,
                                           feature_action_id,stddev,
                                           censor_code,quality_code)
-                            print(' ')
+                                # now we write the extesion values
+                                for item in mquals:
+                                    odmx.write_result_extension_property_values(
+                                         odmx_db_con,
+                                         result_id=result_written_id,
+                                         property_id=usgs_property_id,
+                                         property_value=item
+                                   )
+                                for item in vquals:
+                                    odmx.write_result_extension_property_values(
+                                         odmx_db_con,
+                                         result_id=result_written_id,
+                                         property_id=usgs_property_id,
+                                         property_value=item
+                                   )
                         else:
-                            # these values needs to be tr
-                            # first we find the initial cases whoch quantify it
-                            # we have two cases we can have
-                            # - zero or one  measurement qualifier
-                            # - zero, one or more vqc qualifie
-                            print('we have a non matching value: ')
-                            print('rowvalue :', rowvalue)
-
-                            measurement_qualifiers = \
-                                list(self.remarks_df["censor_cv"])
-                            vqc_qualifiers = list(self.vqc_df["val_qual_nm"])
-                            vqc_qualifier=False
-                            measurement_qualifier=0
-                            vqc_qualifier_case=0
-                            mquals=[]
-                            vquals=[]
-                            mcount=0
-                            vcount=0
-                            for item in measurement_qualifiers:
-                                if item in rowvalue:
-                                    mcount=mcount+1
-                                    mquals.append(item)
-                            if 'vqc_qualifier' in rowvalue:
-                                vqc_qualifier=True
-                                # we try to match rowvalue with the entries
-                                for item in vqc_qualifiers:
-                                    if item in rowvalue:
-                                        vcount=vcount+1
-                                        vquals.append(item)
-                            # we have an issue that we do not have a match
-                            if vqc_qualifier is True and vcount==0:
-                                print(' error  - we have an undefined vqc_code')
-                                exit('undefined vqc_code')
-                            if mcount==0 and vcount==0:
-                                print(' error  - mcount and vcount both 0')
-                                print(' rowvalue: ',rowvalue)
-                                exit('no matches')
-                            # we now iterate over the arrays and write the entries
-                            # we also still need to extract the value
-                            # we also write the value (optionally)
-                            news=rowvalue.replace('vqc_qualifier_','').replace('qualifier_','')
-                            for item in measurement_qualifiers:
-                                news=news.replace(item,'')
-                            for item in vqc_qualifiers:
-                                news=news.replace(item,'')
-                            news=news.replace('_','').replace('_','')
-                            # print('news',news,'rowvalue',rowvalue)
-                            # now we will do the following
-                            # we will write a value
-                            censor_code = ''
-                            # as this data has issues we give it a flag of marginal so that
-                            # we can decide whether to keep it
-                            quality_code='marginal'
-                            if news != '':
-                                if(float(news)):
-                                    result_written_id = write_sample_results(odmx_db_con,
-                                              units_id,variable_id, news,
-                                              timestamp, timezone, depth_m,
-                                              data_type, passed_result_id,
-                                              feature_action_id,stddev,
-                                              censor_code,quality_code)
-                                    # now we write the extesion values
-                                    for item in mquals:
-                                        odmx.write_result_extension_property_values(
-                                             con,
-                                             result_id=result_written_id,
-                                             property_id=usgs_property_id,
-                                             property_value=item
-                                       )
-                                    for item in vquals:
-                                        odmx.write_result_extension_property_values(
-                                             con,
-                                             result_id=result_written_id,
-                                             property_id=usgs_property_id,
-                                             property_value=item
-                                       )
-                            else:
-                                print('we will not write this as it is not a numberx xxxx')
+                            print('we will not write this as it is not a numberx xxxx')
+            write_sample_results_many(odmx_db_con, sample_results)
         print(f'New Variables to add: {need_to_add}')
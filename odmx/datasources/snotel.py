@@ -8,7 +8,6 @@ Module for SNOTEL data harvesting, ingestion, and processing.
 import os
 import datetime
 from importlib.util import find_spec
-from functools import reduce
 import io
 import pandas as pd
 import numpy as np
@@ -201,7 +200,9 @@ class SnotelDataSource(DataSource):
                             'unit': variable['units']['abbreviation']}
                 vars_dict[key] = var_info
         # Creating a space for a no-values return, since that can happen.
-        df_temp_list = []
+        # Each variable becomes a Series indexed by timestamp, so they can
+        # all be aligned in one go.
+        series_list = []
         no_vals_list = []
         # Loop through the variables and get the DataFrames.
         for variable_code, variable_info in vars_dict.items():
@@ -214,24 +215,26 @@ class SnotelDataSource(DataSource):
                                          **params,
                                          suds_client=suds_client,
                                          waterml_namespace=waterml_namespace)
-                datetimes_list = [value['datetime']
-                                  for value in values['values']]
-                values_list = [value['value'] for value in values['values']]
-                df = pd.DataFrame(list(zip(datetimes_list, values_list)),
-                                  columns=['timestamp', variable_name])
-                df.rename(columns={variable_name: new_name}, inplace=True)
-                df['timestamp'] = pd.to_datetime(df['timestamp'])
-                df_temp_list.append(df)
+                readings = values['values']
+                series = pd.Series(
+                    [value['value'] for value in readings],
+                    index=pd.to_datetime([value['datetime']
+                                          for value in readings]),
+                    name=new_name)
+                # Aligning needs unique timestamps. A repeated timestamp keeps
+                # its first reading, as NWIS harvest does.
+                series_list.append(
+                    series[~series.index.duplicated(keep='first')])
             except suds.WebFault:
                 print(f"No new {variable_name} data available.")
                 no_vals_list.append(new_name)
 
-        # Combine the DataFrames if any were created.
-        if df_temp_list:
-            df = reduce(lambda left, right: pd.merge(left, right,
-                                                     on=['timestamp'],
-                                                     how='outer'),
-                        df_temp_list)
+        # Combine the variables if any were returned, this is an outer join
+        # on the timestamps.
+        if series_list:
+            df = pd.concat(series_list, axis=1)
+            df.index.name = 'timestamp'
+            df.reset_index(inplace=True)
             # Check to see if any extra columns need to be added (columns that
             # the station does have data for, but not necessarily in the
             # timeframe specified).
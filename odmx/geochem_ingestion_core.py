@@ -40,6 +40,7 @@ def child_sf_routine(con, timestamp, parent_sf_code, child_sf_code,
     child_sf_id = write_child_sampling_feature(
         con, child_sf_code, parent_sf_code, relation)
     vprint(f"Created sampling feature ID {child_sf_id}.")
+    _child_sf_routine_cache[child_sf_code] = (child_sf_id, False)
     # Write to the `specimens` table.
     specimen_type_cv = 'grab'
     specimen_medium_cv = 'liquidAqueous'
@@ -85,6 +86,7 @@ def fieldspecimen_child_sf_creation(con, timestamp, parent_sf_code,
     child_sf_id = write_child_sampling_feature(
         con, child_sf_code, parent_sf_code, relation)
     vprint(f"Created sampling feature ID {child_sf_id}.")
+    _child_sf_routine_cache[child_sf_code] = (child_sf_id, False)
     # Write to the `specimens` table.
     is_field_specimen = True
     odmx.write_specimens(con, child_sf_id, specimen_type_cv, specimen_medium_cv,
@@ -94,6 +96,27 @@ def fieldspecimen_child_sf_creation(con, timestamp, parent_sf_code,
                                      specimen_collection_id)
     return (child_sf_id, True)
 
+def prefetch_child_sampling_features(con, code_prefix):
+    """
+    Load every existing sampling feature whose code starts with a prefix into
+    the child sampling feature cache, so the creation routines above don't
+    need a query per sample to find out that it already exists.
+
+    @param con The connection object.
+    @param code_prefix The prefix shared by the child sampling feature codes.
+    @return The number of sampling features that were cached.
+    """
+    count = 0
+    for child_sf in odmx.read_sampling_features_fuzzy(
+            con, sampling_feature_code=code_prefix):
+        # The fuzzy read matches anywhere in the code
+        if not child_sf.sampling_feature_code.startswith(code_prefix):
+            continue
+        _child_sf_routine_cache[child_sf.sampling_feature_code] = (
+            child_sf.sampling_feature_id, False)
+        count += 1
+    return count
+
 def sampleaction_routine(con, analyst_name,affiliation_id, analysis_date,
                          analysis_timezone, action_file_link):
     """
@@ -157,6 +180,16 @@ def sampleaction_routine(con, analyst_name,affiliation_id, analysis_date,
 
     return action_id
 
+# Another recipe for time zone.
+_timezone_utc_offsets = {
+    'eastern standard time': -4,
+    'est': -4,
+    'mountain standard time': -7,
+    'mst': -7,
+    'pacific standard time': -8,
+    'pst': -8,
+}
+
 def write_sample_results(con, units_id,variable_id,
                     data_entry_value, timestamp, timezone, depth, data_type,
                     passed_result_id, feature_action_id,stddev,
@@ -212,19 +245,8 @@ def write_sample_results(con, units_id,variable_id,
         data_value = float(data_entry_value)
     except ValueError:
         data_value = 0.0
-    # Another recipe for time zone.
-    timezone_dict = {
-        'eastern standard time': -4,
-        'est': -4,
-        'mountain standard time': -7,
-        'mst': -7,
-        'pacific standard time': -8,
-        'pst': -8,
-    }
-    try:
-        result_date_time_utc_offset = timezone_dict[timezone.lower()]
-    except KeyError:
-        result_date_time_utc_offset = 0
+    result_date_time_utc_offset = _timezone_utc_offsets.get(
+        timezone.lower(), 0)
     # Get the aggregation_statistic_cv.
     # LBNL data has value/stdev pairs, or just a value, so we've designed the
     # system around this concept.
@@ -334,6 +356,91 @@ def write_sample_results(con, units_id,variable_id,
                     " reading nor a standard deviation. This should be"
                     " impossible.")
 
+def write_sample_results_many(con, sample_results):
+    """
+    Write the instrument readings of many samples at once.
+
+    This writes the same `results`, `measurement_results`, and
+    `measurement_result_values` rows as `write_sample_results` does for an
+    instrument reading, but with one bulk insert per table rather than three
+    inserts per value.
+
+    @param con The connection object.
+    @param sample_results A list of (units_id, variable_id, data_entry_value,
+                          timestamp, timezone, depth, feature_action_id,
+                          quality_code) tuples.
+    @return The number of results written.
+    """
+    if not sample_results:
+        return 0
+    processing_level_id = odmx.read_processing_levels_one(
+            con,
+            definition='unknown').processing_level_id
+    results = []
+    for (units_id, variable_id, _, timestamp, timezone, _,
+         feature_action_id, _) in sample_results:
+        assert variable_id is not None
+        assert units_id is not None
+        results.append(odmx.Results(
+            result_uuid=str(uuid.uuid4()),
+            feature_action_id=feature_action_id,
+            result_type_cv='measurement',
+            variable_id=variable_id,
+            units_id=units_id,
+            processing_level_id=processing_level_id,
+            result_date_time=timestamp,
+            result_date_time_utc_offset=_timezone_utc_offsets.get(
+                timezone.lower(), 0),
+            status_cv='complete',
+            value_count=1,
+            no_data_value=-999.999))
+    odmx.write_results_many(con, results)
+    # The bulk insert doesn't hand back the new IDs, so look them up by UUID.
+    result_ids = {
+        result.result_uuid: result.result_id
+        for result in odmx.read_results_any(
+            con, result_uuid=[result.result_uuid for result in results])
+    }
+
+    meter_units_id = None
+    measurement_results = []
+    measurement_result_values = []
+    for result, (_, _, data_entry_value, timestamp, _, depth, _,
+                 quality_code) in zip(results, sample_results):
+        result_id = result_ids[result.result_uuid]
+        z_location = None
+        z_location_units_id = None
+        if depth is not None:
+            if meter_units_id is None:
+                meter_units_id = \
+                    odmx.read_cv_units_one(con, term='meter').units_id
+            z_location = float(depth)
+            z_location_units_id = meter_units_id
+        measurement_results.append(odmx.MeasurementResults(
+            result_id=result_id,
+            z_location=z_location,
+            z_location_units_id=z_location_units_id))
+        try:
+            data_value = float(data_entry_value)
+        except ValueError:
+            data_value = 0.0
+        if str(data_entry_value).lower().replace('.', '') == 'nd':
+            censor_code_cv = 'nonDetect'
+            data_value = 0.0
+        else:
+            censor_code_cv = 'notCensored'
+        measurement_result_values.append(odmx.MeasurementResultValues(
+            result_id=result_id,
+            data_value=data_value,
+            value_date_time=timestamp,
+            value_date_time_utc_offset=result.result_date_time_utc_offset,
+            aggregation_statistic_cv='instrumentReading',
+            censor_code_cv=censor_code_cv,
+            quality_code_cv=quality_code or 'notAssessed'))
+    odmx.write_measurement_results_many(con, measurement_results)
+    odmx.write_measurement_result_values_many(con, measurement_result_values)
+    return len(results)
+
 def feature_action(odmx_db_con, action_id, subspecimen_sf_id):
     # Now write to `feature_actions`, `results`, `measurement_results`,
     # and `mesurement_result_values` tables.
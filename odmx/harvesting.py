@@ -32,10 +32,15 @@ class CsvHeaderError(Exception):
     """
 
 def commit_csv(csv_path, new_data_df, old_data_df, ignore_missing=True,
-        update_added=True, alert_on_added = True, to_csv_args=None):
+        update_added=True, alert_on_added = True, to_csv_args=None,
+        old_header_only=False):
     """
     Updates a CSV file according to the data in the given pandas df. If the
     columns differ, we have two options
+
+    If old_header_only is True, old_data_df only needs to hold the header of
+    the existing csv. The rows are only read from the file if the columns
+    changed and the whole file has to be rewritten.
     """
     if to_csv_args is None:
         to_csv_args = {}
@@ -81,6 +86,11 @@ def commit_csv(csv_path, new_data_df, old_data_df, ignore_missing=True,
             if alert_on_added and len(added) > 0:
                 print("TODO: Alert that additional headers have been added to "
                     f"'{csv_path}': '{added}'")
+            if old_header_only:
+                nlevels = old_data_df.columns.nlevels
+                old_data_df = pd.read_csv(
+                    csv_path,
+                    header=list(range(nlevels)) if nlevels > 1 else 0)
             data_df = pd.concat([old_data_df, new_data_df])
             data_df.to_csv(csv_path, index=False, header=True, **to_csv_args)
     else:
@@ -11,6 +11,7 @@ import argparse
 import importlib
 import json
 import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 from odmx.support.config import Config
 # from odmx.log import set_verbose
 from odmx.log import vprint
@@ -26,6 +27,9 @@ from odmx.shared_conf import setup_base_config, validate_config
 # from beartype import beartype
 # from beartype.typing import Optional
 
+# How many harvests of data sources with parallel_harvest set run at once
+HARVEST_WORKERS = int(os.getenv("ODMX_HARVEST_WORKERS", "4"))
+
 @dataclasses.dataclass
 class DataSourceInfo:
     """
@@ -326,10 +330,43 @@ def run_pipeline(conf: Config, pipeline_work_dir: str):
         populate_base_tables(odmx_db_con, global_path, project_path)
     if 'harvest' in conf.data_processes:
         print("Starting harvest process.")
-        for data_source in data_sources:
-            obj = data_source.data_source_obj
-            obj.harvest(
-                    **data_source.harvesting_info)
+        # Harvests that only wait on a remote service run side by side, the
+        # rest run one after the other as before.
+        with ThreadPoolExecutor(max_workers=HARVEST_WORKERS) as executor:
+            harvests = {}
+            for data_source in data_sources:
+                obj = data_source.data_source_obj
+                if obj.parallel_harvest:
+                    harvests[executor.submit(
+                        obj.harvest, **data_source.harvesting_info)] = \
+                        data_source
+            failures = []
+            for data_source in data_sources:
+                obj = data_source.data_source_obj
+                if obj.parallel_harvest:
+                    continue
+                try:
+                    obj.harvest(**data_source.harvesting_info)
+                except Exception as e:  # pylint: disable=broad-except
+                    # Stop the serial harvests as before, but still wait on
+                    # the workers below so their failures are reported too.
+                    failures.append((data_source, e))
+                    break
+            for harvest, data_source in harvests.items():
+                error = harvest.exception()
+                if error is not None:
+                    failures.append((data_source, error))
+        if failures:
+            messages = []
+            for data_source, error in failures:
+                site = getattr(data_source.data_source_obj, 'site_code', '')
+                message = (f"{data_source.data_source_type} {site}: "
+                           f"{error!r}")
+                vprint(f"Harvest failed for {message}")
+                messages.append(message)
+            raise RuntimeError(
+                f"Harvest failed for {len(failures)} data source(s): "
+                + "; ".join(messages)) from failures[0][1]
     if 'ingest' in conf.data_processes:
         print("Starting ingest process.")
         for data_source in data_sources:
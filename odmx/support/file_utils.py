@@ -5,19 +5,31 @@ File utilities for the ODMX package
 """
 import os
 import json
+from functools import lru_cache
 import filelock
 import jsonschema
 import pandas as pd
 
+# Character replacements for clean_name. Collapsing '__' has to happen after
+# the separators are turned into '_' and before the rest, so the single
+# character replacements are split in two translation tables around it.
+_CLEAN_NAME_SEPARATORS = str.maketrans({' ': '_', '-': '_', '/': '_',
+                                        '²': '2', '³': '3', '°': 'deg'})
+_CLEAN_NAME_SYMBOLS = str.maketrans({'%': 'percent', '^': '', 'µ': 'u',
+                                     'Ω': 'ohm', '₂': '2', ':': ''})
+
+
+@lru_cache(maxsize=4096)
 def clean_name(col):
     """
     Generate ingested name from csv column name
+
+    The result only depends on the name, so it is cached; the same column
+    names come up for every file and every ingest.
     """
-    replace_chars = {' ': '_', '-': '_', '/': '_', '²': '2', '³': '3',
-                     '°': 'deg', '__': '_', '%': 'percent', '^': '', 'µ': 'u',
-                     'Ω': 'ohm', '₂': '2', ':':''}
-    for key, value in replace_chars.items():
-        col = col.replace(key, value)
+    col = col.translate(_CLEAN_NAME_SEPARATORS)
+    col = col.replace('__', '_')
+    col = col.translate(_CLEAN_NAME_SYMBOLS)
 
     # Make lowercase after replacement, it applies to Greek letters too
     # and that may change the meaning (e.g. ω doesn't mean ohms)
@@ -264,9 +276,11 @@ def get_last_timestamp_csv(file_path, timestamp_index=0, max_line_size=8192,
         if size == 0:
             # print(f"Notice: file '{file_path}' is empty.")
             return None
-        # Get the last line.
-        f.seek(-max_line_size, os.SEEK_END)
-        last_line = f.read().splitlines()[-1]
+        # Get the last line. Files smaller than max_line_size are read whole,
+        # and trailing blank lines are skipped.
+        f.seek(max(size - max_line_size, 0))
+        last_line = [line for line in f.read().splitlines()
+                     if line.strip()][-1]
         # Convert the bytes to a string.
         last_line = last_line.decode('utf-8')
         # Get the timestamp from the last line, which is the first
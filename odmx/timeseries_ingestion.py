@@ -73,15 +73,9 @@ def general_timeseries_ingestion(feeder_db_con, feeder_table, df):
         print(f"\"{feeder_table}\" doesn't exist yet."
               " Creating it.")
         # Since pandas.to_sql doesn't support primary key creation, we need
-        # to handle that. First we make the table in PostgreSQL.
-        query = f'''
-            CREATE TABLE {quote_id(feeder_db_con,
-                           feeder_table)}
-                (index SERIAL PRIMARY KEY)
-        '''
-        feeder_db_con.execute(query)
-        add_columns(feeder_db_con, feeder_table,
-                df.columns.tolist())
+        # to handle that. We make the table in PostgreSQL with the primary key
+        # and all of the data columns in one statement.
+        create_table(feeder_db_con, feeder_table, df.columns.tolist())
     # If it does exist, we only want to add new data to it.
     else:
         # First check if we added any columns
@@ -127,25 +121,54 @@ def general_timeseries_ingestion(feeder_db_con, feeder_table, df):
                      #write_cols, update_cols)
 
 
-def add_columns(feeder_con, feeder_table, columns, col_type=None,
-                override_all=None):
+def _column_definitions(columns, col_type=None, override_all=None):
     """
-    Adds columns to a given table
+    Build the column definitions used when creating or altering a feeder
+    table.
+
+    @param columns The column names.
+    @param col_type The column type, double precision by default.
+    @param override_all If True, the timestamp column gets col_type too
+                        instead of a non-null timestamp.
+    @return A list of quoted column name and type strings.
     """
-    # Now we need to add columns and define their types. Construct a string
-    # for that.
     if col_type is None:
         col_type = 'double precision'
     if override_all is None:
         override_all = False
-    col_str = ''
-    for i, col in enumerate(columns):
+    definitions = []
+    for col in columns:
         _col_type = col_type
         if col == 'timestamp' and not override_all:
             _col_type = 'timestamp without time zone NOT NULL'
-        col_str = f'{col_str}ADD COLUMN \"{col}\" {_col_type}'
-        if i < len(columns) - 1:
-            col_str = f'{col_str}, '
+        definitions.append(f'\"{col}\" {_col_type}')
+    return definitions
+
+
+def create_table(feeder_con, feeder_table, columns, col_type=None,
+                 override_all=None):
+    """
+    Creates a feeder table with a serial primary key and the given columns
+    """
+    col_str = ''.join(f', {definition}' for definition in
+                      _column_definitions(columns, col_type, override_all))
+    query = f'''
+        CREATE TABLE {quote_id(feeder_con,
+                           feeder_table)}
+            (index SERIAL PRIMARY KEY{col_str})
+    '''
+    return feeder_con.execute(query)
+
+
+def add_columns(feeder_con, feeder_table, columns, col_type=None,
+                override_all=None):
+    """
+    Adds columns to a given table
+    """
+    # Now we need to add columns and define their types. Construct a string
+    # for that.
+    col_str = ', '.join(f'ADD COLUMN {definition}' for definition in
+                        _column_definitions(columns, col_type, override_all))
     query = f'''
         ALTER TABLE {quote_id(feeder_con,
                            feeder_table)}
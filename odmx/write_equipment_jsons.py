@@ -9,7 +9,6 @@ import shutil
 import json
 import datetime
 from importlib.util import find_spec
-from deepdiff import DeepDiff
 from odmx.log import vprint
 from odmx.support.file_utils import open_json, open_csv, clean_name,\
     expand_column_names
@@ -162,6 +161,16 @@ def read_or_start_data_to_equipment_json(data_to_equipment_map_file,
     return data_to_equip, col_list
 
 
+def _canonical_json(data):
+    """
+    Serialize data so that equal json documents give equal strings.
+
+    @param data The json serializable data.
+    @return The serialized data with sorted keys.
+    """
+    return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+
 def check_diff_and_write_new(new_data, existing_file):
     """
     Check if json file has changed, if it has back up the original before
@@ -172,9 +181,10 @@ def check_diff_and_write_new(new_data, existing_file):
     if os.path.exists(existing_file):
         with open(existing_file, 'r', encoding='utf-8') as f:
             existing_map = json.load(f)
-        deepdiff = DeepDiff(existing_map, new_data)
-        if deepdiff:
-            vprint(f"Existing map differs from new map: {deepdiff}")
+        # Comparing the canonical json is all we need to know whether the
+        # file would change, and it's much cheaper than a DeepDiff.
+        if _canonical_json(existing_map) != _canonical_json(new_data):
+            vprint(f"Existing map in {existing_file} differs from new map")
             vprint("Backing up existing json")
             date_str = datetime.datetime.now().strftime("%Y%m%d")
             shutil.copyfile(existing_file,
@@ -191,6 +201,28 @@ def check_diff_and_write_new(new_data, existing_file):
             json.dump(new_data, f, ensure_ascii=False, indent=4)
 
 
+def _read_existing_equipment_uuids(equip_file):
+    """
+    Read the uuids of the equipment already in an equipment.json, so that
+    regenerating it keeps the same uuids.
+
+    @param equip_file Path of the (possibly) existing equipment.json
+    @return A dictionary of uuids keyed by equipment code and serial number
+    """
+    uuids = {}
+    if not os.path.isfile(equip_file):
+        return uuids
+    with open(equip_file, 'r', encoding='utf-8') as f:
+        to_check = list(json.load(f))
+    while to_check:
+        equipment = to_check.pop()
+        key = (equipment.get('equipment_code'),
+               equipment.get('equipment_serial_number'))
+        uuids.setdefault(key, equipment.get('equipment_uuid'))
+        to_check.extend(equipment.get('equipment') or [])
+    return uuids
+
+
 def generate_equipment_jsons(equipment_path,
                              data_block,
                              time_col,
@@ -228,9 +260,14 @@ def generate_equipment_jsons(equipment_path,
     else:
         end = end_override
 
+    # Reuse the uuids of equipment that is already there, new uuids would
+    # break the links to anything written with the old ones
+    existing_uuids = _read_existing_equipment_uuids(equip_file)
+
     # Start equipment.json entries
     equipment = gen_equipment_entry(
-        acquiring_instrument_uuid=None,
+        acquiring_instrument_uuid=existing_uuids.get(
+            (logger['equipment_name'], logger['equipment_serial_number'])),
         code=logger['equipment_name'],
         name=logger['equipment_name'],
         serial_number=logger['equipment_serial_number'],
@@ -291,7 +328,8 @@ def generate_equipment_jsons(equipment_path,
 
             # Generate equipment entry
             child = gen_equipment_entry(
-                acquiring_instrument_uuid=None,
+                acquiring_instrument_uuid=existing_uuids.get(
+                    (sensor_code, sensor['serial_number'])),
                 code=sensor_code,
                 name=sensor['sensor_name'],
                 serial_number=sensor['serial_number'],